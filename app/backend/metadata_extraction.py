@@ -1,100 +1,193 @@
 import asyncio
-import base64
 import csv
+import hashlib
+import io
 import os
+import random
 
 import aiohttp
+import orjson
 
+# Služba Azure Document Intelligence a model použitý k extrakci metadat
+DOCUMENT_INTELLIGENCE_ENDPOINT = "https://ai-viktorsohajekai089949226317.cognitiveservices.azure.com"
+DOCUMENT_MODEL_ID = "Tatra_ner_v2"
+DOCUMENT_INTELLIGENCE_API_VERSION = "2024-07-31-preview"
 
-# Function to load base64 string from file
-def load_base64_from_pdf_file(file_path):
+# Maximální počet dokumentů zpracovávaných současně a velikost poolu spojení
+MAX_CONCURRENT_FILES = 16
+MAX_CONNECTIONS = 32
+
+# Parametry exponenciálního čekání mezi opakovanými dotazy na službu (v sekundách)
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 5.0
+POLL_BACKOFF_FACTOR = 1.7
+# Maximální počet opakování dotazu po omezení počtu požadavků (429) nebo chybě serveru (5xx)
+MAX_RETRIES = 8
+
+# Pole extrahovaná z dokumentů, v pořadí sloupců souboru s metadaty
+METADATA_FIELDS = ("contracting_party", "valid_to", "signed_date", "signatory_tatra")
+
+
+# Function to load raw bytes from file
+def load_bytes_from_pdf_file(file_path):
     with open(file_path, "rb") as pdf_file:
-        encoded_string = base64.b64encode(pdf_file.read())
-    return encoded_string.decode("utf-8")
+        return pdf_file.read()
+
+
+# Function to compute the content hash used as the key of the analysis cache
+def get_content_hash(document_bytes):
+    return hashlib.sha256(document_bytes).hexdigest()
+
+
+# Function to append CSV rows to a file with a single write
+def append_csv_rows(file_path, rows):
+    # Nothing to write, do not create an empty file
+    if not rows:
+        return
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator="\n").writerows(rows)
+    with open(file_path, "a", newline="") as f:
+        f.write(buffer.getvalue())
+
+
+# Function to compute the wait before the next retry: exponential delay with jitter, but at least Retry-After
+def get_retry_wait(delay, retry_after):
+    wait = delay + random.uniform(0, delay * 0.25)
+    if retry_after is not None and retry_after.isdigit():
+        wait = max(wait, float(retry_after))
+    return wait
 
 
-# Define the parser function
+# Define the parser function, extracting content of the metadata fields only
 def parse_fields(fields):
-    parsed_fields = []
-    for key, value in fields.items():
-        field_data = {
-            "field_name": key,
-            "content": value.get("content", None),
-            "pageNumber": value.get("boundingRegions", [{}])[0].get("pageNumber", None),
-            "confidence": value.get("confidence", None),
-        }
-        parsed_fields.append(field_data)
-    return parsed_fields
-
-
-# Function to analyze document and get apim-request-id from the response headers
-async def analyze_document_async(base64_string, api_key, session):
+    return {key: fields[key].get("content", "") if key in fields else "" for key in METADATA_FIELDS}
+
+
+# Function to analyze document and get the Operation-Location polling URL from the response headers
+async def analyze_document_async(document_bytes, api_key, session):
     """Asynchronně analyzuje dokument pomocí Azure Document Intelligence."""
-    url = "https://ai-viktorsohajekai089949226317.cognitiveservices.azure.com/documentintelligence/documentModels/Tatra_ner_v2:analyze?api-version=2024-07-31-preview"
-    headers = {"Content-type": "application/json", "Ocp-apim-subscription-key": api_key}
-    data = {"base64Source": base64_string}
+    url = f"{DOCUMENT_INTELLIGENCE_ENDPOINT}/documentintelligence/documentModels/{DOCUMENT_MODEL_ID}:analyze?api-version={DOCUMENT_INTELLIGENCE_API_VERSION}"
+    # Dokument posíláme přímo jako binární data, bez kódování do base64
+    headers = {"Content-type": "application/pdf", "Ocp-apim-subscription-key": api_key}
 
-    async with session.post(url, headers=headers, json=data) as response:
-        apim_request_id = response.headers.get("apim-request-id", "Not Found")
-        return apim_request_id
+    delay = POLL_INITIAL_DELAY
+    retries = 0
+    while True:
+        async with session.post(url, headers=headers, data=document_bytes) as response:
+            # Při omezení počtu požadavků (429) odeslání zopakujeme, jiné chyby vyvoláme
+            if response.status != 429 or retries >= MAX_RETRIES:
+                response.raise_for_status()
+                return response.headers["Operation-Location"]
+            retry_after = response.headers.get("Retry-After")
+        retries += 1
+        await asyncio.sleep(get_retry_wait(delay, retry_after))
+        delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY)
 
 
-# Function to get analysis results based on apim_request_id
-async def get_analysis_results_async(apim_request_id, api_key, session):
-    """Asynchronně získává výsledky analýzy na základě apim_request_id, dokud není stav 'succeeded'."""
+# Function to get analysis results from the Operation-Location URL
+async def get_analysis_results_async(operation_location, api_key, session):
+    """Asynchronně získává výsledky analýzy z adresy Operation-Location, dokud není stav 'succeeded'."""
 
-    url = f"https://ai-viktorsohajekai089949226317.cognitiveservices.azure.com/documentintelligence/documentModels/Tatra_ner_v2/analyzeResults/{apim_request_id}?api-version=2024-07-31-preview"
     headers = {"Ocp-apim-subscription-key": api_key}
 
+    delay = POLL_INITIAL_DELAY
+    retries = 0
     while True:
-        async with session.get(url, headers=headers) as response:
-            response_json = await response.json()
-            if response_json["status"] == "succeeded":
-                return response_json
-            elif response_json["status"] == "failed":
-                raise ValueError(
-                    f"Azure Document Intelligence analysis failed: {response_json.get('error', 'Unknown error')}"
-                )
+        async with session.get(operation_location, headers=headers) as response:
+            retry_after = response.headers.get("Retry-After")
+            if (response.status == 429 or response.status >= 500) and retries < MAX_RETRIES:
+                # Omezení počtu požadavků i přechodnou chybu serveru zopakujeme jen omezeně
+                retries += 1
+                status = "retry"
             else:
-                await asyncio.sleep(5)  # Počkáme 5 sekund před dalším pokusem
+                response.raise_for_status()
+                response_json = orjson.loads(await response.read())
+                status = response_json["status"]
+        if status == "succeeded":
+            return response_json
+        elif status == "failed":
+            raise ValueError(
+                f"Azure Document Intelligence analysis failed: {response_json.get('error', 'Unknown error')}"
+            )
+        elif status not in ("notStarted", "running", "retry"):
+            raise ValueError(f"Unexpected Azure Document Intelligence analysis status: {status}")
+
+        # Počkáme s exponenciálně rostoucí prodlevou a náhodným rozptylem, nejméně však dobu z Retry-After
+        await asyncio.sleep(get_retry_wait(delay, retry_after))
+        delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY)
+
+
+async def analyze_and_parse_document_async(document_bytes, api_key, session):
+    """Asynchronně analyzuje dokument a vrátí hodnoty extrahovaných polí."""
+    operation_location = await analyze_document_async(document_bytes, api_key, session)
+    result = await get_analysis_results_async(operation_location, api_key, session)
+    return parse_fields(result["analyzeResult"]["documents"][0]["fields"])
+
+
+async def process_file_async(file_name, api_key, session, semaphore, content_hash_cache, analyses_in_progress):
+    """Asynchronně zpracuje jeden soubor, přičemž dokument se stejným obsahem analyzuje jen jednou."""
+    async with semaphore:
+        # Čtení PDF a výpočet hashe jsou blokující, proto běží mimo event loop
+        document_bytes = await asyncio.to_thread(load_bytes_from_pdf_file, os.path.join(data_folder_path, file_name))
+        content_hash = await asyncio.to_thread(get_content_hash, document_bytes)
+        if content_hash in content_hash_cache:
+            return file_name, content_hash, content_hash_cache[content_hash]
+        if content_hash not in analyses_in_progress:
+            analyses_in_progress[content_hash] = asyncio.create_task(
+                analyze_and_parse_document_async(document_bytes, api_key, session)
+            )
+            return file_name, content_hash, await analyses_in_progress[content_hash]
+    # Duplicitní soubor čeká na výsledek analýzy mimo semafor, aby neblokoval ostatní soubory
+    return file_name, content_hash, await analyses_in_progress[content_hash]
 
 
-async def process_files(new_file_names, api_key):
+async def process_files(new_file_names, api_key, content_hash_cache):
     """Asynchronně zpracovává seznam souborů pomocí Azure Document Intelligence."""
 
-    async with aiohttp.ClientSession() as session:
-        # 1. Spustíme analýzu dokumentů paralelně
-        analysis_tasks = [
-            analyze_document_async(
-                load_base64_from_pdf_file(os.path.join(data_folder_path, file_name)), api_key, session
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+    analyses_in_progress = {}
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS, ttl_dns_cache=300, keepalive_timeout=60
+    )
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # 1. Spustíme zpracování všech dokumentů paralelně, s omezeným počtem současně běžících
+        tasks = [
+            asyncio.create_task(
+                process_file_async(file_name, api_key, session, semaphore, content_hash_cache, analyses_in_progress)
             )
             for file_name in new_file_names
         ]
-        apim_request_ids = await asyncio.gather(*analysis_tasks)
 
-        # 2. Získáme výsledky analýz paralelně
-        results_tasks = [
-            get_analysis_results_async(apim_request_id, api_key, session) for apim_request_id in apim_request_ids
-        ]
-        results = await asyncio.gather(*results_tasks)
-
-        # 3. Zpracujeme výsledky a uložíme je do metadat
-        output = {}
-        for file_name, result in zip(new_file_names, results):
-            fields = result["analyzeResult"]["documents"][0]["fields"]
-            output[file_name] = parse_fields(fields)
-        
-        with open(metadata_file_path, "a", newline="") as f:
-            with open(data_folder_path + "partner_file_mapping.txt", "a") as partner_file_mapping:
-                for file_name, parsed_fields in output.items():
-                    field_values = {"contracting_party": "", "valid_to": "", "signed_date": "", "signatory_tatra": ""}
-                    for field in parsed_fields:
-                        if field["field_name"] in field_values:
-                            field_values[field["field_name"]] = field["content"]
-                    f.write(
-                        f"\"{file_name}\",\"{field_values['contracting_party']}\",\"{field_values['valid_to']}\",\"{field_values['signed_date']}\",\"{field_values['signatory_tatra']}\"\n"
+        # 2. Výsledky sbíráme v paměti průběžně, jak jednotlivé analýzy doběhnou
+        metadata_rows = []
+        partner_file_mapping_rows = []
+        content_hash_cache_rows = []
+        try:
+            for future in asyncio.as_completed(tasks):
+                file_name, content_hash, field_values = await future
+                metadata_rows.append([file_name, *(field_values[field_name] for field_name in METADATA_FIELDS)])
+                partner_file_mapping_rows.append([file_name, field_values["contracting_party"]])
+                if content_hash not in content_hash_cache:
+                    content_hash_cache[content_hash] = field_values
+                    content_hash_cache_rows.append(
+                        [
+                            content_hash,
+                            DOCUMENT_MODEL_ID,
+                            DOCUMENT_INTELLIGENCE_API_VERSION,
+                            *(field_values[field_name] for field_name in METADATA_FIELDS),
+                        ]
                     )
-                    partner_file_mapping.write(f"\"{file_name}\",\"{field_values['contracting_party']}\"\n")
+        finally:
+            # Při chybě zrušíme zbývající úlohy a počkáme na ně, než se zavře session
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            # 3. Řádky zapíšeme na disk jedním zápisem do každého souboru,
+            # i při chybě, aby se neztratily výsledky již dokončených analýz
+            append_csv_rows(metadata_file_path, metadata_rows)
+            append_csv_rows(data_folder_path + "partner_file_mapping.txt", partner_file_mapping_rows)
+            append_csv_rows(content_hash_cache_path, content_hash_cache_rows)
 
 
 def check_and_get_new_files(metadata_file_path, data_folder_path):
@@ -102,19 +195,16 @@ def check_and_get_new_files(metadata_file_path, data_folder_path):
     processed_files = set()
     if os.path.exists(metadata_file_path):
         with open(metadata_file_path) as f:
-            # Skip the first 3 lines (header)
+            # Skip the first 3 lines (header), tolerating a shorter file
             for _ in range(3):
-                next(f)
+                next(f, None)
 
-            # Read the remaining lines and extract file names
-            for line in f:
-                reader = csv.reader([line])  # Create a csv reader for the single line
-                for row in reader:  # There should be only one row
-                    processed_files.add(row[0])  # Add the first column (file name)
+            # Read the remaining lines with a single reader and extract file names (first column)
+            processed_files = {row[0] for row in csv.reader(f) if row}
 
-    # Get all files in the data folder
-    all_files = set(os.listdir(data_folder_path))
-    all_pdf_files = {file for file in all_files if file.endswith(".pdf")}
+    # Get all PDF files in the data folder in a single directory scan
+    with os.scandir(data_folder_path) as entries:
+        all_pdf_files = {entry.name for entry in entries if entry.name.endswith(".pdf") and entry.is_file()}
 
     # Find new files to process
     new_files = all_pdf_files - processed_files
@@ -127,9 +217,27 @@ def check_and_get_new_files(metadata_file_path, data_folder_path):
         return []  # Return an empty list if no new files are found
 
 
+def load_content_hash_cache(content_hash_cache_path):
+    # Load field values of already analyzed documents keyed by their content hash (first column),
+    # ignoring rows produced by a different model or API version
+    content_hash_cache = {}
+    if os.path.exists(content_hash_cache_path):
+        with open(content_hash_cache_path, newline="") as f:
+            for row in csv.reader(f):
+                if (
+                    len(row) == len(METADATA_FIELDS) + 3
+                    and row[1] == DOCUMENT_MODEL_ID
+                    and row[2] == DOCUMENT_INTELLIGENCE_API_VERSION
+                ):
+                    content_hash_cache[row[0]] = dict(zip(METADATA_FIELDS, row[3:]))
+    return content_hash_cache
+
+
 if __name__ == "__main__":
     data_folder_path = "./data/"
     metadata_file_path = "./data/documents_metadata.txt"
+    # Skrytý soubor, který prepdocs ('./data/*') neindexuje
+    content_hash_cache_path = "./data/.content_hash_cache.txt"
     api_key = os.environ.get("AZURE_AI_SERVICE_API_KEY")
 
     # Get new files to process, ensuring we have full file paths
@@ -138,5 +246,6 @@ if __name__ == "__main__":
         print("No new files")
     else:
         print(f"Processing files: {new_file_names}")
-        # Process files asynchronously
-        asyncio.run(process_files(new_file_names, api_key))
+        # Process files asynchronously, reusing results of documents with already known content
+        content_hash_cache = load_content_hash_cache(content_hash_cache_path)
+        asyncio.run(process_files(new_file_names, api_key, content_hash_cache))
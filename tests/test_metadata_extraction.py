@@ -0,0 +1,238 @@
+import json
+import os
+
+import aiohttp
+import pytest
+
+import metadata_extraction
+from metadata_extraction import (
+    DOCUMENT_INTELLIGENCE_API_VERSION,
+    DOCUMENT_MODEL_ID,
+    append_csv_rows,
+    check_and_get_new_files,
+    load_content_hash_cache,
+    parse_fields,
+    process_files,
+)
+
+METADATA_HEADER = "header 1\nheader 2\nheader 3\n"
+
+
+class MockDocumentIntelligenceResponse:
+    def __init__(self, status, body=None, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status)
+
+    async def read(self):
+        return json.dumps(self.body).encode()
+
+
+@pytest.fixture
+def mock_document_intelligence(monkeypatch, tmp_path):
+    """Mocks the analyze and poll endpoints. PDFs containing b"fail" fail while polling, after a few polls."""
+    calls = {"post": [], "get": {}}
+
+    def mock_post(self, url, *args, **kwargs):
+        content = kwargs["data"].decode()
+        calls["post"].append(content)
+        return MockDocumentIntelligenceResponse(202, headers={"Operation-Location": f"https://poll/{content}"})
+
+    def mock_get(self, url, *args, **kwargs):
+        content = url.split("/")[-1]
+        calls["get"][content] = calls["get"].get(content, 0) + 1
+        if content == "fail":
+            if calls["get"][content] < 5:
+                return MockDocumentIntelligenceResponse(200, {"status": "running"})
+            return MockDocumentIntelligenceResponse(400, {"error": {"code": "InvalidRequest"}})
+        fields = {"contracting_party": {"content": f"Party {content}"}, "valid_to": {"content": "31.12.2025"}}
+        return MockDocumentIntelligenceResponse(
+            200, {"status": "succeeded", "analyzeResult": {"documents": [{"fields": fields}]}}
+        )
+
+    monkeypatch.setattr(aiohttp.ClientSession, "post", mock_post)
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+    monkeypatch.setattr(metadata_extraction, "POLL_INITIAL_DELAY", 0)
+    monkeypatch.setattr(metadata_extraction, "data_folder_path", f"{tmp_path}/", raising=False)
+    monkeypatch.setattr(
+        metadata_extraction, "metadata_file_path", str(tmp_path / "documents_metadata.txt"), raising=False
+    )
+    monkeypatch.setattr(
+        metadata_extraction, "content_hash_cache_path", str(tmp_path / ".content_hash_cache.txt"), raising=False
+    )
+    return calls
+
+
+def test_parse_fields():
+    fields = {
+        "contracting_party": {"content": "ACME s.r.o.", "confidence": 0.9, "boundingRegions": [{"pageNumber": 1}]},
+        "valid_to": {"content": "31.12.2025"},
+        "signed_date": {"confidence": 0.1},
+        "unrelated_field": {"content": "ignored"},
+    }
+    assert parse_fields(fields) == {
+        "contracting_party": "ACME s.r.o.",
+        "valid_to": "31.12.2025",
+        "signed_date": "",
+        "signatory_tatra": "",
+    }
+
+
+def test_check_and_get_new_files(tmp_path):
+    metadata_file_path = tmp_path / "documents_metadata.txt"
+    metadata_file_path.write_text(
+        'header 1\nheader 2\nheader 3\n"old.pdf","ACME","31.12.2025","1.1.2024","Jan Novak"\n'
+    )
+    (tmp_path / "old.pdf").write_bytes(b"old")
+    (tmp_path / "new.pdf").write_bytes(b"new")
+    (tmp_path / "notes.txt").write_text("not a pdf")
+    os.mkdir(tmp_path / "folder.pdf")
+
+    assert check_and_get_new_files(str(metadata_file_path), str(tmp_path)) == ["new.pdf"]
+
+
+def test_check_and_get_new_files_without_metadata(tmp_path):
+    (tmp_path / "new.pdf").write_bytes(b"new")
+
+    assert check_and_get_new_files(str(tmp_path / "documents_metadata.txt"), str(tmp_path)) == ["new.pdf"]
+
+
+def test_check_and_get_new_files_nothing_new(tmp_path):
+    metadata_file_path = tmp_path / "documents_metadata.txt"
+    metadata_file_path.write_text('header 1\nheader 2\nheader 3\n"old.pdf","ACME","","",""\n')
+    (tmp_path / "old.pdf").write_bytes(b"old")
+
+    assert check_and_get_new_files(str(metadata_file_path), str(tmp_path)) == []
+
+
+def test_load_content_hash_cache(tmp_path):
+    content_hash_cache_path = tmp_path / ".content_hash_cache.txt"
+    content_hash_cache_path.write_text(
+        f'"hash1","{DOCUMENT_MODEL_ID}","{DOCUMENT_INTELLIGENCE_API_VERSION}","ACME ""Holding""","31.12.2025","1.1.2024","Jan Novak"\n'
+        # Rows from another model or API version are stale and ignored
+        f'"hash2","{DOCUMENT_MODEL_ID}","2023-07-31","ACME","31.12.2025","1.1.2024","Jan Novak"\n'
+        f'"hash4","Other_model","{DOCUMENT_INTELLIGENCE_API_VERSION}","ACME","31.12.2025","1.1.2024","Jan Novak"\n'
+        # Malformed rows are ignored
+        '"hash3","ACME"\n'
+        "\n"
+    )
+
+    assert load_content_hash_cache(str(content_hash_cache_path)) == {
+        "hash1": {
+            "contracting_party": 'ACME "Holding"',
+            "valid_to": "31.12.2025",
+            "signed_date": "1.1.2024",
+            "signatory_tatra": "Jan Novak",
+        }
+    }
+
+
+def test_load_content_hash_cache_missing_file(tmp_path):
+    assert load_content_hash_cache(str(tmp_path / ".content_hash_cache.txt")) == {}
+
+
+def test_append_csv_rows_roundtrip(tmp_path):
+    content_hash_cache_path = str(tmp_path / ".content_hash_cache.txt")
+    model = [DOCUMENT_MODEL_ID, DOCUMENT_INTELLIGENCE_API_VERSION]
+    append_csv_rows(content_hash_cache_path, [["hash1", *model, 'ACME "Holding"', "31.12.2025", "", ""]])
+    append_csv_rows(content_hash_cache_path, [["hash2", *model, "Firma, a.s.", "", "1.1.2024", "Jan Novak"]])
+
+    assert load_content_hash_cache(content_hash_cache_path) == {
+        "hash1": {
+            "contracting_party": 'ACME "Holding"',
+            "valid_to": "31.12.2025",
+            "signed_date": "",
+            "signatory_tatra": "",
+        },
+        "hash2": {
+            "contracting_party": "Firma, a.s.",
+            "valid_to": "",
+            "signed_date": "1.1.2024",
+            "signatory_tatra": "Jan Novak",
+        },
+    }
+
+
+def test_check_and_get_new_files_short_metadata(tmp_path):
+    metadata_file_path = tmp_path / "documents_metadata.txt"
+    metadata_file_path.write_text("")
+    (tmp_path / "new.pdf").write_bytes(b"new")
+
+    assert check_and_get_new_files(str(metadata_file_path), str(tmp_path)) == ["new.pdf"]
+
+
+def test_append_csv_rows_no_rows(tmp_path):
+    file_path = tmp_path / "documents_metadata.txt"
+    append_csv_rows(str(file_path), [])
+
+    assert not file_path.exists()
+
+
+@pytest.mark.asyncio
+async def test_process_files_saves_completed_rows_on_failure(mock_document_intelligence, tmp_path):
+    metadata_file_path = tmp_path / "documents_metadata.txt"
+    metadata_file_path.write_text(METADATA_HEADER)
+    (tmp_path / "ok.pdf").write_bytes(b"ok")
+    (tmp_path / "broken.pdf").write_bytes(b"fail")
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await process_files(["ok.pdf", "broken.pdf"], "key", {})
+
+    # The completed analysis is saved, so the next run only retries the failed file
+    assert metadata_file_path.read_text() == METADATA_HEADER + '"ok.pdf","Party ok","31.12.2025","",""\n'
+    assert (tmp_path / "partner_file_mapping.txt").read_text() == '"ok.pdf","Party ok"\n'
+    assert check_and_get_new_files(str(metadata_file_path), str(tmp_path)) == ["broken.pdf"]
+
+    (tmp_path / "broken.pdf").write_bytes(b"fixed")
+    await process_files(["broken.pdf"], "key", load_content_hash_cache(str(tmp_path / ".content_hash_cache.txt")))
+
+    assert check_and_get_new_files(str(metadata_file_path), str(tmp_path)) == []
+    assert mock_document_intelligence["post"] == ["ok", "fail", "fixed"]
+
+
+@pytest.mark.asyncio
+async def test_process_files_failure_without_results_creates_no_files(mock_document_intelligence, tmp_path):
+    (tmp_path / "broken.pdf").write_bytes(b"fail")
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await process_files(["broken.pdf"], "key", {})
+
+    assert sorted(os.listdir(tmp_path)) == ["broken.pdf"]
+    assert check_and_get_new_files(str(tmp_path / "documents_metadata.txt"), str(tmp_path)) == ["broken.pdf"]
+
+
+@pytest.mark.asyncio
+async def test_process_files_analyzes_identical_pdfs_once(mock_document_intelligence, tmp_path):
+    metadata_file_path = tmp_path / "documents_metadata.txt"
+    metadata_file_path.write_text(METADATA_HEADER)
+    (tmp_path / "a.pdf").write_bytes(b"same")
+    (tmp_path / "a_copy.pdf").write_bytes(b"same")
+    (tmp_path / "b.pdf").write_bytes(b"other")
+
+    await process_files(["a.pdf", "a_copy.pdf", "b.pdf"], "key", {})
+
+    assert sorted(mock_document_intelligence["post"]) == ["other", "same"]
+    assert sorted(metadata_file_path.read_text().splitlines()[3:]) == [
+        '"a.pdf","Party same","31.12.2025","",""',
+        '"a_copy.pdf","Party same","31.12.2025","",""',
+        '"b.pdf","Party other","31.12.2025","",""',
+    ]
+    content_hash_cache = load_content_hash_cache(str(tmp_path / ".content_hash_cache.txt"))
+    assert len(content_hash_cache) == 2
+
+    # A later run reuses the cached results for known content without calling the service
+    (tmp_path / "a_renamed.pdf").write_bytes(b"same")
+    await process_files(["a_renamed.pdf"], "key", content_hash_cache)
+
+    assert len(mock_document_intelligence["post"]) == 2
+    assert metadata_file_path.read_text().splitlines()[-1] == '"a_renamed.pdf","Party same","31.12.2025","",""'